@@ -301,8 +301,7 @@ def build_results(interactions: pd.DataFrame,
 def deconvoluted_complex_result_build(clusters_means: dict, interactions: pd.DataFrame,
                                       complex_compositions: pd.DataFrame, counts: pd.DataFrame,
                                       genes: pd.DataFrame, counts_data: str) -> pd.DataFrame:
-    genes_counts = list(counts.index)
-    genes_filtered = genes[genes[counts_data].apply(lambda gene: gene in genes_counts)]
+    genes_filtered = genes[genes[counts_data].isin(counts.index)]
 
     deconvoluted_complex_result_1 = deconvolute_complex_interaction_component(complex_compositions, genes_filtered,
                                                                               interactions, '_1', counts_data)
@@ -265,8 +265,7 @@ def deconvoluted_complex_result_build(clusters_means: pd.DataFrame,
                                       counts: pd.DataFrame,
                                       genes: pd.DataFrame,
                                       counts_data: str) -> (pd.DataFrame, pd.DataFrame):
-    genes_counts = list(counts.index)
-    genes_filtered = genes[genes['id_multidata'].apply(lambda gene: gene in genes_counts)]
+    genes_filtered = genes[genes['id_multidata'].isin(counts.index)]
 
     deconvoluted_complex_result_1 = deconvolute_complex_interaction_component(complex_compositions,
                                                                               genes_filtered,
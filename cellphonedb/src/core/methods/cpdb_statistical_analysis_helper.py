@@ -98,6 +98,17 @@ def shuffle_meta(meta: pd.DataFrame) -> pd.DataFrame:
     return meta_copy
 
 
+def _complex_min_per_cluster(cluster_values: np.ndarray, complex_to_protein_row_ids: dict) -> np.ndarray:
+    """
+    For each complex, takes the minimum across the rows of its proteins in cluster_values (genes x clusters).
+    The result (complexes x clusters) is filled in place in a preallocated array.
+    """
+    complex_values = np.empty((len(complex_to_protein_row_ids), cluster_values.shape[1]), dtype=cluster_values.dtype)
+    for i, protein_row_ids in enumerate(complex_to_protein_row_ids.values()):
+        complex_values[i] = cluster_values[protein_row_ids].min(axis=0)
+    return complex_values
+
+
 def build_clusters(meta: pd.DataFrame,
                    counts: pd.DataFrame,
                    complex_to_protein_row_ids: dict,
@@ -142,7 +153,7 @@ def build_clusters(meta: pd.DataFrame,
     )
     if not skip_percent:
         cluster_pcts = pd.DataFrame(
-            npg.aggregate(meta[CELL_TYPE].cat.codes, (counts > 0).astype(int).values, func='mean', axis=1),
+            npg.aggregate(codes, counts.to_numpy() > 0, func='mean', axis=1),
             index=counts.index,
             columns=cluster_names.to_list()
         )
@@ -151,20 +162,19 @@ def build_clusters(meta: pd.DataFrame,
 
     # Complex genes cluster counts
     if complex_to_protein_row_ids:
-        cluster_means_x = cluster_means.values
+        complex_ids = list(complex_to_protein_row_ids)
         complex_cluster_means = pd.DataFrame(
-            {complex_id: cluster_means_x[protein_row_ids].min(axis=0)
-             for complex_id, protein_row_ids in complex_to_protein_row_ids.items()},
-            index=cluster_means.columns
-        ).T
+            _complex_min_per_cluster(cluster_means.values, complex_to_protein_row_ids),
+            index=complex_ids,
+            columns=cluster_means.columns
+        )
         cluster_means = pd.concat([cluster_means, complex_cluster_means])
-        cluster_pcts_x = cluster_pcts.values
         if not skip_percent:
             complex_cluster_pcts = pd.DataFrame(
-                {complex_id: cluster_pcts_x[protein_row_ids].min(axis=0)
-                 for complex_id, protein_row_ids in complex_to_protein_row_ids.items()},
-                index=cluster_pcts.columns
-            ).T
+                _complex_min_per_cluster(cluster_pcts.values, complex_to_protein_row_ids),
+                index=complex_ids,
+                columns=cluster_pcts.columns
+            )
             cluster_pcts = pd.concat([cluster_pcts, complex_cluster_pcts])
     return {'names': cluster_names, 'means': cluster_means, 'percents': cluster_pcts}
 
@@ -189,7 +199,7 @@ def filter_empty_cluster_counts(counts: pd.DataFrame) -> pd.DataFrame:
     if counts.empty:
         return counts
 
-    filtered_counts = counts[counts.apply(lambda row: row.sum() > 0, axis=1)]
+    filtered_counts = counts[counts.to_numpy().sum(axis=1) > 0]
     return filtered_counts
 
 
@@ -260,8 +270,7 @@ def get_cluster_combinations(cluster_names: np.array, microenvs: pd.DataFrame =
     else:
         core_logger.info('Limiting cluster combinations using microenvironments')
         cluster_combinations = []
-        for me in microenvs["microenvironment"].unique():
-            me_cell_types = microenvs[microenvs["microenvironment"] == me]["cell_type"]
+        for _, me_cell_types in microenvs.groupby("microenvironment", sort=False)["cell_type"]:
             combinations = np.array(np.meshgrid(me_cell_types, me_cell_types))
             cluster_combinations.extend(combinations.T.reshape(-1, 2))
         result = pd.DataFrame(cluster_combinations).drop_duplicates().to_numpy()
@@ -725,11 +734,8 @@ def get_involved_complex_from_counts(
         - complex_composition filtered
         - counts filtered
     """
-    proteins_in_complexes = complex_composition['protein_multidata_id'].drop_duplicates().tolist()
-
     # Remove counts that can't be part of a complex
-    counts_filtered = counts[
-        counts.apply(lambda count: count.name in proteins_in_complexes, axis=1)]
+    counts_filtered = counts[counts.index.isin(complex_composition['protein_multidata_id'])]
 
     # Find complexes with all components defined in counts
     complex_composition_filtered = complex_helper.get_involved_complex_composition_from_protein(counts_filtered,
@@ -738,11 +744,8 @@ def get_involved_complex_from_counts(
     if complex_composition_filtered.empty:
         return complex_composition_filtered, pd.DataFrame(columns=counts.columns)
 
-    available_complex_proteins = complex_composition_filtered['protein_multidata_id'].drop_duplicates().to_list()
-
     # Remove counts that are not defined in selected complexes
-    counts_filtered = counts_filtered[
-        counts_filtered.apply(lambda count: count.name in available_complex_proteins, axis=1)]
+    counts_filtered = counts_filtered[counts_filtered.index.isin(complex_composition_filtered['protein_multidata_id'])]
 
     return complex_composition_filtered, counts_filtered
 
@@ -771,21 +774,20 @@ def add_multidata_and_means_to_counts(counts: pd.DataFrame, genes: pd.DataFrame,
         - counts_relations: a subset of counts with only id_multidata and all gene identifiers
     """
     # sort cell names
-    cells_names = sorted(counts.columns)
+    cells_order = np.argsort(counts.columns.to_numpy(), kind='stable')
 
-    # add id multidata to counts input
-    counts = counts.merge(
+    # map the rows of counts to multidata ids - the join is done on the row positions of counts only,
+    # rather than merging the whole (genes x cells) counts matrix with the genes table
+    counts_relations = pd.DataFrame({'counts_row': np.arange(counts.shape[0])}, index=counts.index).merge(
         genes[['id_multidata', 'ensembl', 'gene_name', 'hgnc_symbol']],
         left_index=True,
         right_on=counts_data
     )
+    counts_rows = counts_relations.pop('counts_row').to_numpy()
 
-    counts_relations = counts[['id_multidata', 'ensembl', 'gene_name', 'hgnc_symbol']].copy()
-
-    counts.set_index('id_multidata', inplace=True, drop=True)
-    counts = counts[cells_names]
-    if np.any(counts.dtypes.values != np.dtype('float32')):
-        counts = counts.astype(np.float32)
+    counts = pd.DataFrame(counts.to_numpy(dtype=np.float32)[np.ix_(counts_rows, cells_order)],
+                          index=pd.Index(counts_relations['id_multidata'], name='id_multidata'),
+                          columns=counts.columns[cells_order])
     counts = counts.groupby(counts.index).mean()
 
     return counts, counts_relations
@@ -8,26 +8,16 @@ def get_involved_complex_composition_from_protein(proteins: pd.DataFrame,
     """
     Returns a table of complex with all proteins declared in proteins.
     """
-    multidata_protein = list(proteins.index)
-
-    complex_counts_filtered = complex_compositions[
-        complex_compositions['protein_multidata_id'].apply(lambda protein_multidata: protein_multidata in multidata_protein)]
+    complex_counts_filtered = complex_compositions[complex_compositions['protein_multidata_id'].isin(proteins.index)]
 
     if complex_counts_filtered.empty:
         return pd.DataFrame(columns=complex_compositions.columns)
 
-    def all_protein_involved(complex: pd.Series) -> bool:
-        number_proteins_in_counts = len(
-            complex_counts_filtered[
-                complex_counts_filtered['complex_multidata_id'] == complex['complex_multidata_id']])
-
-        if number_proteins_in_counts < complex['total_protein']:
-            return False
-
-        return True
+    # Number of proteins of each complex present in proteins, counted in a single groupby pass
+    number_proteins_in_counts = complex_counts_filtered.groupby(COMPLEX_ID)[COMPLEX_ID].transform('size')
 
     complex_composition_complete = complex_counts_filtered[
-        complex_counts_filtered.apply(all_protein_involved, axis=1)]
+        ~(number_proteins_in_counts < complex_counts_filtered['total_protein'])]
 
     return complex_composition_complete
 
@@ -8,6 +8,7 @@ import time
 import zipfile
 import itertools
 import pathlib
+import functools
 from cellphonedb.utils.file_utils import dbg
 from cellphonedb.utils import file_utils, unique_id_generator
 import urllib.request
@@ -89,7 +90,23 @@ def get_interactions_genes_complex(cpdb_file_path) -> \
         - complex_expanded: pd.DataFrame
         - gene_synonym2gene_name: dict
         - receptor2tfs: dict
+
+    The data is loaded from cpdb_file_path only once per process (and again if that file is modified in the meantime),
+    e.g. when the analysis method and the interaction scoring both request it. Each call returns copies of the cached
+    data, so callers can modify them freely.
     """
+    # The cache is keyed on the canonical path, so that e.g. relative and absolute paths to the same file share an entry
+    cpdb_file_path = os.path.realpath(cpdb_file_path)
+    interactions, genes, complex_composition, complex_expanded, gene_synonym2gene_name, receptor2tfs = \
+        _load_interactions_genes_complex(cpdb_file_path, os.path.getmtime(cpdb_file_path))
+    return interactions.copy(), genes.copy(), complex_composition.copy(), complex_expanded.copy(), \
+        dict(gene_synonym2gene_name), {receptor: list(tfs) for receptor, tfs in receptor2tfs.items()}
+
+
+@functools.lru_cache(maxsize=4)
+def _load_interactions_genes_complex(cpdb_file_path, mtime) -> \
+        Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, dict, dict]:
+    # mtime is only part of the cache key, so that a modified cpdb_file_path is re-loaded
     # Extract csv files from db_files_path/cellphonedb.zip into dbTableDFs
     dbTableDFs = extract_dataframes_from_db(cpdb_file_path)
     # Convert dbTableDFs into interactions, genes, complex_composition, complex_expanded data frames
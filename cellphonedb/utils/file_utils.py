@@ -259,14 +259,22 @@ def save_scored_interactions_as_zip(out, suffix, analysis_name, interaction_scor
     if suffix is None:
         suffix = get_timestamp_suffix()
     os.makedirs(out, exist_ok=True)
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a",
-                         zipfile.ZIP_DEFLATED, False) as zip_file:
-        for ctPair, df in interaction_scores_dict.items():
-            zip_file.writestr('{}.csv'.format(ctPair), df.to_csv(index=False, sep=',').encode('utf-8'))
     file_path = os.path.join(out, '{}_{}_{}.{}'.format(analysis_name, name, suffix, "zip"))
-    with open(file_path, 'wb') as f:
-        f.write(zip_buffer.getvalue())
+    # Stream each csv directly into its entry of the zip file on disk, rather than building the csv strings
+    # and the whole zip archive in memory first. The zip is written to a temporary file that only replaces
+    # file_path once all csv files have been written, so that a failure does not leave a truncated zip behind.
+    tmp_file_path = file_path + '.tmp'
+    try:
+        with zipfile.ZipFile(tmp_file_path, "w",
+                             zipfile.ZIP_DEFLATED, False) as zip_file:
+            for ctPair, df in interaction_scores_dict.items():
+                with io.TextIOWrapper(zip_file.open('{}.csv'.format(ctPair), 'w'), encoding='utf-8',
+                                      newline='') as csv_file:
+                    df.to_csv(csv_file, index=False, sep=',')
+        os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
     print("Saved {} to {}".format(name, file_path))
 
 
@@ -1,13 +1,55 @@
 import pandas as pd
 import numpy as np
+import numpy_groupies as npg
 from cellphonedb.utils import db_utils
-from sklearn.preprocessing import MinMaxScaler
 from cellphonedb.src.core.core_logger import core_logger
-from collections import ChainMap
+from collections import ChainMap, defaultdict
 
-from functools import partial
-from multiprocessing.pool import Pool
-from tqdm.std import tqdm
+try:
+    import numexpr
+except ImportError:
+    # numexpr is optional: without it interaction scores are calculated with NumPy only
+    numexpr = None
+
+
+def _cell_type_codes(matrix: pd.DataFrame, metadata: pd.DataFrame, cell_column_name: str) -> tuple:
+    """
+    Encodes the cell type of each barcode in the columns of matrix as an integer code,
+    so that per cell type reductions can be computed with npg.aggregate.
+
+    Returns
+    -------
+    tuple
+        (cell types, cell type code of each barcode in matrix - or -1 if the barcode is not in metadata)
+    """
+    labels = metadata[cell_column_name]
+    # Barcodes are matched to the columns of matrix by position when metadata is already in the same order,
+    # and looked up by label otherwise (barcodes missing from metadata get a NaN label, hence code -1)
+    if not labels.index.equals(matrix.columns):
+        labels = labels.reindex(matrix.columns)
+    labels = labels.astype('category').cat.remove_unused_categories()
+    codes = labels.cat.codes.to_numpy()
+    return labels.cat.categories, codes
+
+
+def _aggregate_per_cell_type(matrix_np: np.ndarray, codes: np.ndarray, n_cell_types: int,
+                             func: str, dtype: type, nonzero: bool = False) -> np.ndarray:
+    """
+    Applies npg.aggregate along the barcodes (columns) of matrix_np, grouped by cell type code.
+    If nonzero is True, func is applied to the (expression != 0) mask instead of the expression values.
+    Barcodes without a cell type (code -1) are left out of the aggregation.
+    Rows are processed in chunks to bound the size of the temporary arrays created by the aggregation.
+    """
+    if (codes < 0).any():
+        matrix_np, codes = matrix_np[:, codes >= 0], codes[codes >= 0]
+    chunk_size = max(1, 2**20 // max(1, matrix_np.shape[1]))
+    result = np.empty((matrix_np.shape[0], n_cell_types), dtype=dtype)
+    for start in range(0, matrix_np.shape[0], chunk_size):
+        chunk = matrix_np[start:start + chunk_size]
+        if nonzero:
+            chunk = chunk != 0
+        result[start:start + chunk_size] = npg.aggregate(codes, chunk, func=func, size=n_cell_types, axis=1)
+    return result
 
 
 def filter_genes_per_cell_type(
@@ -24,7 +66,7 @@ def filter_genes_per_cell_type(
     ----------
     matrix: Normalized gene expression matrix (genes x barcodes).
     metadata: Index contains the barcode id and a single column named 'cell_type' indicating the group/cell type which
-              the barcode belongs to.
+              the barcode belongs to. Barcodes of matrix that are not in metadata are ignored.
     min_pct_cell : Percentage of cells required to express a given gene.
     cell_column_name: Name of the column containing cell types
 
@@ -35,28 +77,23 @@ def filter_genes_per_cell_type(
         min_pct_cell of cells
     """
     core_logger.info("Scoring interactions: Filtering genes per cell type..")
-    matrix = matrix.copy()
-
-    # Cell types present in metadata
-    cell_type_data = set(metadata[cell_column_name])
+    matrix_np = matrix.to_numpy(dtype=np.float32, copy=True)
 
-    for cell_type in tqdm(cell_type_data):
-        # Obtain the barcode of the cells annotated under cell_type
-        idx = metadata[cell_column_name] == cell_type
-        cell_barcode = list(metadata.index[idx])
+    cell_types, codes = _cell_type_codes(matrix, metadata, cell_column_name)
 
-        # Calculate percentage of cells expressing the gene (expression != 0)
-        gene_expr_pct = (matrix[cell_barcode] != 0).sum(axis=1) / len(cell_barcode)
+    # Calculate percentage of cells expressing the gene (expression != 0) in all cell types at once
+    gene_expr_pct = _aggregate_per_cell_type(matrix_np, codes, len(cell_types), func='mean', dtype=np.float64,
+                                             nonzero=True)
 
-        # List of genes lowly expressed
-        gene_lowly_expr = list(gene_expr_pct.index[gene_expr_pct < min_pct_cell])
-
-        # Set expression to zero for genes expressed in a given cell type below the
-        # user defined min_pct_cell
-        matrix.loc[gene_lowly_expr, cell_barcode] = 0
+    # Set expression to zero for genes expressed in a given cell type below the
+    # user defined min_pct_cell
+    gene_lowly_expr = gene_expr_pct < min_pct_cell
+    for cell_type_code in range(len(cell_types)):
+        matrix_np[np.ix_(np.flatnonzero(gene_lowly_expr[:, cell_type_code]),
+                         np.flatnonzero(codes == cell_type_code))] = 0
 
     # Return filtered matrix
-    return matrix
+    return pd.DataFrame(matrix_np, index=matrix.index, columns=matrix.columns)
 
 
 def mean_expression_per_cell_type(matrix: pd.DataFrame, metadata: pd.DataFrame, cell_column_name: str) -> pd.DataFrame:
@@ -67,7 +104,7 @@ def mean_expression_per_cell_type(matrix: pd.DataFrame, metadata: pd.DataFrame,
     ----------
     matrix: Normalized gene expression matrix (genes x barcodes).
     metadata: Index contains the barcode id and a single column named 'cell_type' indicating the group/cell type which
-              the barcode belongs to.
+              the barcode belongs to. Barcodes of matrix that are not in metadata are ignored.
     cell_column_name: Name of the column containing cell types
 
     Returns
@@ -77,31 +114,24 @@ def mean_expression_per_cell_type(matrix: pd.DataFrame, metadata: pd.DataFrame,
 
     """
     core_logger.info("Scoring interactions: Calculating mean expression of each gene per group/cell type..")
-    matrix = matrix.copy()
-    out_dict = {}
-
-    # Cell types present in Metadata
-    cell_type_data = set(metadata[cell_column_name])
-
-    for cell_type in tqdm(cell_type_data):
-        # Obtain the barcode of the cells annotated with cell_type
-        idx = metadata[cell_column_name] == cell_type
-        cell_barcode = list(metadata.index[idx])
+    cell_types, codes = _cell_type_codes(matrix, metadata, cell_column_name)
 
-        # Calculate mean expression per cell type
-        out_dict[cell_type] = matrix[cell_barcode].mean(axis=1)
+    # Calculate mean expression of all cell types at once. npg.aggregate accumulates in double precision,
+    # so the means match those calculated per cell type with pandas.
+    means = _aggregate_per_cell_type(matrix.to_numpy(dtype=np.float32), codes, len(cell_types),
+                                     func='mean', dtype=np.float32)
 
-    # Convert the dictionary to a dataframe
-    matrix_mean_expr = pd.DataFrame.from_dict(out_dict)
+    matrix_mean_expr = pd.DataFrame(means, index=matrix.index, columns=cell_types)
 
     return matrix_mean_expr
 
 
-def _geometric_mean(x):
-    sub_values = list(x)
-    sub_prod = np.prod(sub_values)
-    geom = np.power(sub_prod, 1 / len(sub_values))
-    return (geom)
+def _geometric_mean(x: np.ndarray, axis: int) -> np.ndarray:
+    # Computed in log space to avoid the overflow of the product of many values;
+    # a zero value gives log(0) = -inf and hence a geometric mean of 0.
+    # Logs are accumulated in double precision and the result is cast back to the dtype of x.
+    with np.errstate(divide='ignore'):
+        return np.exp(np.log(x, dtype=np.float64).mean(axis=axis)).astype(x.dtype, copy=False)
 
 
 def heteromer_geometric_expression_per_cell_type(
@@ -129,19 +159,16 @@ def heteromer_geometric_expression_per_cell_type(
         are the ones for which all the constituent genes are present in matrix
     """
 
-    matrix = matrix.copy()
-
     # If the existing index does not contain genes[counts_data], replace it with index containing genes[counts_data] -
     if matrix.index.intersection(genes[counts_data]).empty:
         index_name = matrix.index.name
         matrix = matrix.reset_index()
-        matrix[index_name].replace(to_replace=id2name, inplace=True)
+        matrix[index_name] = matrix[index_name].replace(to_replace=id2name)
         matrix.set_index(index_name, inplace=True)
         matrix.index.name = None
 
     # Subset the mean expression matrix to keep only the genes in CellphoneDB
-    idx = [gene in list(genes[counts_data]) for gene in matrix.index]
-    matrix = matrix.loc[idx]
+    matrix = matrix.loc[matrix.index.isin(genes[counts_data])]
 
     # Map complex name to its constituents/subunits
     complex_composition = pd.merge(complex_composition,
@@ -158,7 +185,7 @@ def heteromer_geometric_expression_per_cell_type(
     # The geometric mean is always lower than the arithmetic mean due to a compounding effect. Note that this is different
     # than in CellphoneDB methods themselves where the minimum expression across all parts of a heteromer is taken
     # as its overall expression.
-    complex_geom_mean = dict()
+    complex_rows = dict()
     for complex_id in complex_name_2_subunits:
 
         # set used below to eliminate duplicate gene names
@@ -168,20 +195,35 @@ def heteromer_geometric_expression_per_cell_type(
         # Remove nan values from heteromers
         subunits_list = [i for i in subunits_set if str(i) != 'nan']
 
+        # All rows of matrix for the subunits (a gene name may appear in more than one row; -1 if it is absent)
+        rows = matrix.index.get_indexer_for(subunits_list)
+
         # Test if all the members of subunits_list are present in matrix
         # if true then calculate the geometric mean of the complex
-        check_subunit = all([sub in matrix.index for sub in subunits_list])
+        check_subunit = (rows >= 0).all()
         if check_subunit:
-            complex_geom_mean[complex_id] = matrix.loc[subunits_list,].apply(_geometric_mean, axis=0)
+            complex_rows[complex_id] = rows
 
-    # Convert geometric mean dictionary to dataframe
-    complex_geom_mean_df = pd.DataFrame.from_dict(complex_geom_mean,
-                                                  orient='index')
+    # Group complexes by their number of rows, so that the geometric means of all complexes in a group
+    # are calculated at once on a (complexes x subunits x cell types) array
+    complexes_by_size = defaultdict(list)
+    for complex_pos, rows in enumerate(complex_rows.values()):
+        complexes_by_size[len(rows)].append(complex_pos)
+
+    matrix_np = matrix.to_numpy(dtype=np.float32)
+    complex_rows_list = list(complex_rows.values())
+    complex_geom_mean = np.empty((len(complex_rows), matrix.shape[1]), dtype=matrix_np.dtype)
+    for complex_positions in complexes_by_size.values():
+        rows = np.array([complex_rows_list[pos] for pos in complex_positions])
+        complex_geom_mean[complex_positions] = _geometric_mean(matrix_np[rows], axis=1)
+
+    complex_geom_mean_df = pd.DataFrame(complex_geom_mean,
+                                        index=list(complex_rows),
+                                        columns=matrix.columns)
 
     # Detect and remove genes that have the same name as a complex, e.g. OSMR, LIFR, IL2
     # Otherwise two rows assigned to the same gene would appear in final_df
-    idx = [i not in complex_geom_mean_df.index for i in matrix.index]
-    matrix = matrix.loc[idx]
+    matrix = matrix.loc[~matrix.index.isin(complex_geom_mean_df.index)]
 
     final_df = pd.concat([matrix, complex_geom_mean_df])
 
@@ -203,9 +245,14 @@ def scale_expression(matrix: pd.DataFrame, upper_range: int) -> pd.DataFrame:
         (genes x cell types) in which, for each gene in a given cell type, the expression was scaled to 0-upper_range
     """
 
-    # Transpose matrix to apply scaling per row (i.e. scale across cell types)
-    scaler = MinMaxScaler(feature_range=(0, upper_range), clip=True).fit(matrix.T)
-    matrix_scaled = scaler.transform(matrix.T).T
+    # Min-max scaling per row (i.e. across cell types), as in sklearn's MinMaxScaler(feature_range=(0, upper_range),
+    # clip=True) fitted on the transposed matrix: genes with a (near) constant expression have their range set to 1
+    matrix_np = matrix.to_numpy(dtype=np.float32)
+    data_min = np.nanmin(matrix_np, axis=1, keepdims=True)
+    data_range = np.nanmax(matrix_np, axis=1, keepdims=True) - data_min
+    data_range[data_range < 10 * np.finfo(data_range.dtype).eps] = 1
+    scale = np.float32(upper_range) / data_range
+    matrix_scaled = np.clip(matrix_np * scale - data_min * scale, 0, upper_range)
 
     matrix_scaled = pd.DataFrame(matrix_scaled,
                                  index=matrix.index,
@@ -213,25 +260,28 @@ def scale_expression(matrix: pd.DataFrame, upper_range: int) -> pd.DataFrame:
     return matrix_scaled
 
 
-def _get_lr_scores(matrix, cpdb_set_all_lrs, separator, cell_type_pair) -> tuple:
-    cell_type_A = cell_type_pair.split(separator)[0]
-    cell_type_B = cell_type_pair.split(separator)[1]
-    # Each cell in lr_outer is an arithmetic product:
-    # gene in row's mean expression in cell_type_A and gene in column's mean expression in cell_type_B
-    lr_outer = pd.DataFrame(np.outer(list(matrix[cell_type_A]),
-                                     list(matrix[cell_type_B])),
-                            index=matrix.index,
-                            columns=matrix.index)
-    # Round scores to 3 decimal places
-    lr_outer = np.around(lr_outer, 3)
-    df = lr_outer.stack().reset_index()
-    lr_outer_long = pd.DataFrame({
-        'interacting_pair': df.iloc[:, 0] + "_" + df.iloc[:, 1],
-        "score": df.iloc[:, 2]})
-    # Filtering interactions to only those in CellphoneDB
-    idx_interactions = [i in cpdb_set_all_lrs for i in lr_outer_long['interacting_pair'].values]
-    lr_outer_long_filtered = lr_outer_long.loc[idx_interactions]
-    return (cell_type_pair, lr_outer_long_filtered)
+def _get_lr_scores(matrix_np, partner_rows, cell_type_cols, threads) -> np.ndarray:
+    rows_a, rows_b = partner_rows
+    cols_a, cols_b = cell_type_cols
+    # Each score is an arithmetic product: partner a's mean expression in the first cell type of a pair and
+    # partner b's mean expression in the second one. All (interacting pairs x cell type pairs) scores are
+    # calculated at once.
+    expr_a = matrix_np[np.ix_(rows_a, cols_a)]
+    expr_b = matrix_np[np.ix_(rows_b, cols_b)]
+    if numexpr is not None:
+        # numexpr evaluates the product in cache-sized blocks, using threads
+        # numexpr raises an error if asked for more than MAX_THREADS threads
+        previous_threads = numexpr.set_num_threads(max(1, min(threads, numexpr.MAX_THREADS)))
+        try:
+            scores = numexpr.evaluate('expr_a * expr_b', local_dict={'expr_a': expr_a, 'expr_b': expr_b})
+        finally:
+            # Only restore a valid previous value: set_num_threads() rejects non-positive numbers of threads
+            if previous_threads > 0:
+                numexpr.set_num_threads(previous_threads)
+    else:
+        scores = expr_a * expr_b
+    # Round scores to 3 decimal places (in double precision, so that the rounded values are exact decimals)
+    return np.around(scores.astype(np.float64), 3)
 
 
 def score_product(matrix: pd.DataFrame,
@@ -255,7 +305,7 @@ def score_product(matrix: pd.DataFrame,
     means: A copy of one of the result DataFrames of CellphoneDB that interaction scores will be populated into
     separator: separator character used in cell type pairs
     id2name: A mapping between multidata_id and genes[counts_data]
-    threads: Number of threads to be used for parallel processing
+    threads: Number of threads used by numexpr (if installed) to calculate the scores
 
     Returns
     -------
@@ -265,7 +315,6 @@ def score_product(matrix: pd.DataFrame,
     """
 
     core_logger.info("Scoring interactions: Calculating scores for all interactions and cell types..")
-    matrix = matrix.copy()
     # All means in interaction_scores will be overwritten with scores
     interaction_scores = means
 
@@ -273,24 +322,30 @@ def score_product(matrix: pd.DataFrame,
     interactions_df.replace(to_replace=id2name, inplace=True)
     interactions_df.rename(columns={'multidata_1_id': 'partner_a', 'multidata_2_id': 'partner_b'}, inplace=True)
 
-    # Create lists of the interacting LR (and the reverse) to keep in lr_outer_long only those entries
-    # that are described in the cpdb interaction file
-    cpdb_list_a = list(interactions_df['partner_a']+'_'+interactions_df['partner_b'])
-    cpdb_list_b = list(interactions_df['partner_b']+'_'+interactions_df['partner_a'])
-    cpdb_set_all_lrs = set(cpdb_list_a + cpdb_list_b)
-
+    # Map each interacting pair described in the cpdb interaction file (and its reverse) to the rows
+    # of its partners in matrix, so that only the scores of those pairs are calculated
+    # (if a gene appears in more than one row of matrix, its last row is used)
+    gene2row = pd.Series(np.arange(matrix.shape[0]), index=matrix.index)
+    gene2row = gene2row[~gene2row.index.duplicated(keep='last')]
+    partners = interactions_df.loc[interactions_df['partner_a'].isin(gene2row.index) &
+                                   interactions_df['partner_b'].isin(gene2row.index)]
+    rows_a = partners['partner_a'].map(gene2row)
+    rows_b = partners['partner_b'].map(gene2row)
+    interacting_pair2rows = pd.DataFrame(
+        {'row_a': pd.concat([rows_a, rows_b]).to_numpy(),
+         'row_b': pd.concat([rows_b, rows_a]).to_numpy()},
+        index=pd.concat([partners['partner_a'] + '_' + partners['partner_b'],
+                         partners['partner_b'] + '_' + partners['partner_a']]))
+    interacting_pair2rows = interacting_pair2rows[~interacting_pair2rows.index.duplicated(keep='last')]
+    partner_rows = interacting_pair2rows.loc[interaction_scores['interacting_pair']].to_numpy().T
+
+    matrix_np = matrix.to_numpy(dtype=np.float32)
+    cell_type2col = {cell_type: col for col, cell_type in enumerate(matrix.columns)}
     cell_type_pairs = [c for c in interaction_scores.columns if separator in c]
-    results = []
+    cell_type_cols = np.array([[cell_type2col[cell_type] for cell_type in ct_pair.split(separator)[:2]]
+                               for ct_pair in cell_type_pairs], dtype=int).reshape(-1, 2).T
 
-    with Pool(processes=threads) as pool:
-        _get_lr_scores_thread = partial(_get_lr_scores, matrix, cpdb_set_all_lrs, separator)
-        for tp in tqdm(pool.imap(_get_lr_scores_thread, cell_type_pairs),
-                       total=len(cell_type_pairs)):
-            results.append(tp)
-
-    for ct_pair, lr_scores_filtered in results:
-        interacting_pair2score = dict(zip(lr_scores_filtered['interacting_pair'], lr_scores_filtered['score']))
-        interaction_scores[ct_pair] = [interacting_pair2score[id] for id in interaction_scores['interacting_pair']]
+    interaction_scores[cell_type_pairs] = _get_lr_scores(matrix_np, partner_rows, cell_type_cols, threads)
 
     return interaction_scores
 
@@ -320,6 +375,12 @@ def score_interactions_based_on_participant_expressions_product(
         dict(zip(genes.protein_id, genes[counts_data])),
         dict(zip(complex_expanded.complex_multidata_id, complex_expanded.name))))
 
+    # Expression values are processed in single precision throughout the scoring steps to halve the memory
+    # traffic of the matrix operations below. Scores range up to 100, so 3 decimal places need ~5 of the ~7
+    # significant digits of float32: scores that fall near a rounding boundary can shift by +/-0.001 compared
+    # to a calculation in double precision.
+    counts = counts.astype(np.float32, copy=False)
+
     # Step 1: Filter genes expressed in less than min_pct_cell of cells in a given cell type.
     cpdb_f = filter_genes_per_cell_type(matrix=counts,
                                         metadata=metadata,